@@ -1,32 +1,145 @@
 import streamlit as st
 import pandas as pd
 import sqlite3
+import queue
+import threading
+import openpyxl
+from contextlib import contextmanager
+from functools import wraps
 from datetime import datetime
-from io import StringIO
+from io import BytesIO
+from operator import itemgetter
 
 DB_PATH = "chemicals.db"
+_SQLITE_MAX_PARAMS = 999
+PAGE_SIZE = 50  # rows per page in the dashboard tables
+READ_POOL_SIZE = 4  # idle read-only connections kept for display queries
+
+# Hot statements live in module constants so every call sends identical SQL text
+# and hits sqlite3's per-connection prepared-statement cache.
+_Q_INSERT_NOTIFICATION = "INSERT INTO notifications(recipient,message,created_at) VALUES (?,?,?)"
+_Q_UNSEEN_NOTIFICATIONS = "SELECT id, message, created_at FROM notifications WHERE recipient=? AND seen=0 ORDER BY created_at DESC"
+_Q_FIND_CHEM = "SELECT serial_no,chemical,amount_total,amount_remaining,issued_total,unit,cas_no FROM chemicals WHERE chemical = ?"
+# stock check and arithmetic in one statement; no row comes back when the chemical is missing or stock would go negative
+_Q_ADJUST_STOCK = """UPDATE chemicals
+    SET amount_remaining = amount_remaining + ?,
+        issued_total = issued_total + CASE WHEN ? < 0 THEN -? ELSE 0 END
+    WHERE chemical = ? AND amount_remaining + ? >= 0
+    RETURNING amount_remaining"""
+# deduct an Approved request's amount from its chemical straight from the request id (UPDATE ... FROM,
+# SQLite 3.33+); the status check lives in the statement so a request can never be issued twice
+_Q_DEDUCT_FOR_REQUEST = """UPDATE chemicals
+    SET amount_remaining = amount_remaining - r.amount, issued_total = issued_total + r.amount
+    FROM (SELECT amount, chemical FROM requests WHERE id = ? AND status = 'Approved') AS r
+    WHERE chemicals.chemical = r.chemical AND chemicals.amount_remaining >= r.amount
+    RETURNING chemicals.chemical"""
+_Q_CHEM_REMAINING = "SELECT amount_remaining FROM chemicals WHERE chemical = ?"
+_Q_INSERT_REQUEST = """INSERT INTO requests(username,chemical,amount,note,status,created_at,updated_at)
+                   VALUES (?,?,?,?, 'Pending',?,?)"""
+_Q_REQUEST_BY_ID = "SELECT status, username, chemical, amount FROM requests WHERE id = ?"
+# only a Pending request can be approved or rejected, so an Issued request is never re-approved
+# (and issued again) or relabelled Rejected after its stock was deducted
+_Q_SET_SUPERVISOR_STATUS = """UPDATE requests SET status=?, supervisor=?, updated_at=?
+    WHERE id=? AND status = 'Pending' RETURNING username, chemical, amount"""
+_Q_SET_ISSUED_STATUS = "UPDATE requests SET status=?, lab_incharge=?, updated_at=? WHERE id=? RETURNING username, chemical, amount"
+
+# The only filter shapes list_requests / list_issued accept, keyed by sorted filter keys.
+# Keys never reach the SQL text, and each shape is one fixed, cache-friendly statement.
+_REQ_SELECT = "SELECT id,username,chemical,amount,note,status,supervisor,lab_incharge,created_at,updated_at FROM requests"
+_REQ_QUERIES = {
+    (): _REQ_SELECT + " ORDER BY created_at DESC",
+    ("status",): _REQ_SELECT + " WHERE status = ? ORDER BY created_at DESC",
+    ("username",): _REQ_SELECT + " WHERE username = ? ORDER BY created_at DESC",
+}
+_ISSUED_SELECT = "SELECT id,username,chemical,amount,issued_by,issued_at FROM issued"
+_ISSUED_QUERIES = {
+    (): _ISSUED_SELECT + " ORDER BY issued_at DESC",
+    ("username",): _ISSUED_SELECT + " WHERE username = ? ORDER BY issued_at DESC",
+}
+_Q_ISSUED_LOG = _ISSUED_QUERIES[()]
+# row counts for the same filter shapes, so pagers can show totals without fetching every row
+_REQ_COUNTS = {
+    (): "SELECT COUNT(*) FROM requests",
+    ("status",): "SELECT COUNT(*) FROM requests WHERE status = ?",
+    ("username",): "SELECT COUNT(*) FROM requests WHERE username = ?",
+}
+_ISSUED_COUNTS = {
+    (): "SELECT COUNT(*) FROM issued",
+    ("username",): "SELECT COUNT(*) FROM issued WHERE username = ?",
+}
+_Q_CHEMICALS = "SELECT serial_no,chemical,amount_total,amount_remaining,issued_total,unit,cas_no FROM chemicals ORDER BY serial_no"
+_Q_COUNT_CHEMICALS = "SELECT COUNT(*) FROM chemicals"
+_Q_USER_REQUESTS = "SELECT id,chemical,amount,status,created_at,updated_at FROM requests WHERE username = ? ORDER BY created_at DESC"
 
 # -------------------------
 # Database helpers
 # -------------------------
+def _connect():
+    # every connection the app opens goes through here so the PRAGMAs are always applied
+    conn = sqlite3.connect(DB_PATH, check_same_thread=False, cached_statements=256)
+    conn.row_factory = sqlite3.Row  # rows still unpack like tuples, and can be read by column name
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA cache_size=-20000")       # ~20 MB page cache
+    conn.execute("PRAGMA mmap_size=268435456")     # 256 MB
+    conn.execute("PRAGMA busy_timeout=30000")      # wait up to 30s on a locked db instead of erroring
+    return conn
+
+@st.cache_resource
 def get_conn():
-    return sqlite3.connect(DB_PATH, check_same_thread=False)
+    # one long-lived connection per server process; reused across reruns and sessions
+    return _connect()
+
+# All writes share one connection, so only one thread may drive a write at a time. Reentrant
+# because locked helpers call each other (update_request_status -> push_notifications).
+_WRITE_LOCK = threading.RLock()
+
+def _locked(fn):
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        with _WRITE_LOCK:
+            return fn(*args, **kwargs)
+    return wrapper
+
+@st.cache_resource
+def _read_pool():
+    return queue.Queue(maxsize=READ_POOL_SIZE)
+
+@contextmanager
+def read_conn():
+    # Borrow a query_only connection for display reads. Under WAL these run alongside the shared
+    # writer connection and never see rows from a write transaction it has not committed yet.
+    pool = _read_pool()
+    try:
+        conn = pool.get_nowait()
+    except queue.Empty:
+        conn = _connect()
+        conn.execute("PRAGMA query_only=ON")
+    try:
+        yield conn
+    finally:
+        try:
+            pool.put_nowait(conn)
+        except queue.Full:
+            conn.close()
 
+@_locked
 def init_db():
     conn = get_conn()
     cur = conn.cursor()
 
-    # chemicals master list (private)
+    # chemicals master list (private); keyed by name, so no separate rowid b-tree
     cur.execute("""
     CREATE TABLE IF NOT EXISTS chemicals (
         serial_no INTEGER,
         chemical TEXT PRIMARY KEY,
         amount_total REAL,
-        amount_remaining REAL,
+        amount_remaining REAL CHECK(amount_remaining >= 0),
         issued_total REAL,
         unit TEXT,
         cas_no TEXT
-    )""")
+    ) WITHOUT ROWID""")
 
     # users (simple registry for audit; roles are chosen at login in this demo)
     cur.execute("""
@@ -43,7 +156,8 @@ def init_db():
         chemical TEXT NOT NULL,
         amount REAL NOT NULL,
         note TEXT,
-        status TEXT NOT NULL DEFAULT 'Pending',   -- Pending / Approved / Rejected / Issued
+        status TEXT NOT NULL DEFAULT 'Pending'
+            CHECK(status IN ('Pending', 'Approved', 'Rejected', 'Issued')),
         supervisor TEXT,
         lab_incharge TEXT,
         created_at TEXT,
@@ -71,105 +185,231 @@ def init_db():
         created_at TEXT
     )""")
 
+    # indexes matching the hot filter + ORDER BY paths, so SQLite skips the temp B-tree sort
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_requests_status_created ON requests(status, created_at DESC)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_requests_user_created ON requests(username, created_at DESC)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_notif_recipient_seen ON notifications(recipient, seen, created_at DESC)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_issued_user_time ON issued(username, issued_at DESC)")
+
     conn.commit()
-    conn.close()
+
+    # refresh planner statistics (e.g. the low cardinality of requests.status); analysis_limit
+    # samples each index so this stays cheap on large tables
+    cur.execute("PRAGMA analysis_limit=400")
+    cur.execute("ANALYZE")
+    conn.commit()
+
+@st.cache_resource
+def _init_db_once():
+    # schema and index DDL only needs to run once per server process, not on every rerun
+    init_db()
+    return True
 
 # -------------------------
 # Utility operations
 # -------------------------
+def _paged(query, params, limit, offset):
+    # limit=None means the whole result; otherwise fetch a single page in SQL
+    if limit is None:
+        return query, list(params)
+    return query + " LIMIT ? OFFSET ?", list(params) + [limit, offset]
+
+@st.cache_data(ttl=300)
+def count_rows(query, params=()):
+    # cached like the lists it sizes; the _clear_*_caches helpers clear it too
+    with read_conn() as conn:
+        return conn.execute(query, params).fetchone()[0]
+
 def safe_query_df(query, params=()):
-    conn = get_conn()
-    df = pd.read_sql_query(query, conn, params=params)
-    conn.close()
+    # build the frame straight from the cursor; read_sql_query adds a dispatch layer we don't need
+    with read_conn() as conn:
+        cur = conn.cursor()
+        cur.row_factory = None  # plain tuples are the cheapest input for from_records
+        cur.execute(query, params)
+        df = pd.DataFrame.from_records(cur.fetchall(), columns=[d[0] for d in cur.description])
     return df
 
-def push_notification(recipient, message):
+def _csv_stream(query, params=(), chunksize=5000):
+    # yield the result as CSV text chunk by chunk; only one chunk is ever held as a DataFrame
+    with read_conn() as conn:
+        first = True
+        for chunk in pd.read_sql_query(query, conn, params=params, chunksize=chunksize):
+            yield chunk.to_csv(header=first, index=False)
+            first = False
+
+@st.cache_data(ttl=300)
+def stream_csv(query, params=()):
+    # st.download_button needs the payload up front, so encode each chunk straight into one
+    # bytes buffer rather than building the full CSV str and letting Streamlit encode a copy.
+    # Cached so reruns reuse the export; writes to chemicals / issued call stream_csv.clear().
+    buf = BytesIO()
+    for text in _csv_stream(query, params):
+        buf.write(text.encode("utf-8"))
+    return buf.getvalue()
+
+@_locked
+def push_notifications(notifs, cur=None, now=None):
+    """
+    notifs is a list of (recipient, message). When a cursor is given the rows join the
+    caller's open transaction and are committed with it; otherwise they are committed here.
+    Pass the caller's `now` so every row of one operation carries the same timestamp.
+    """
+    if now is None:
+        now = datetime.utcnow().isoformat()
+    rows = [(recipient, message, now) for recipient, message in notifs]
+    if cur is not None:
+        cur.executemany(_Q_INSERT_NOTIFICATION, rows)
+        return
     conn = get_conn()
-    cur = conn.cursor()
-    cur.execute(
-        "INSERT INTO notifications(recipient,message,created_at) VALUES (?,?,?)",
-        (recipient, message, datetime.utcnow().isoformat())
-    )
-    conn.commit()
-    conn.close()
+    with conn:
+        conn.executemany(_Q_INSERT_NOTIFICATION, rows)
 
-def get_unseen_notifications(user):
+@_locked
+def register_user(username):
     conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("SELECT id, message, created_at FROM notifications WHERE recipient=? AND seen=0 ORDER BY created_at DESC", (user,))
-    rows = cur.fetchall()
-    conn.close()
+    with conn:
+        conn.execute("INSERT OR IGNORE INTO users(username, full_name) VALUES (?, ?)", (username, username))
+
+def push_notification(recipient, message, now=None):
+    push_notifications([(recipient, message)], now=now)
+
+def get_unseen_notifications(user):
+    with read_conn() as conn:
+        rows = conn.execute(_Q_UNSEEN_NOTIFICATIONS, (user,)).fetchall()
     return rows
 
+@_locked
 def mark_notifications_seen(ids):
     if not ids:
         return
+    ids = list(ids)
     conn = get_conn()
-    cur = conn.cursor()
-    cur.executemany("UPDATE notifications SET seen=1 WHERE id=?", [(i,) for i in ids])
-    conn.commit()
-    conn.close()
+    # one UPDATE ... IN (...) per batch, kept under SQLite's default 999 bound-parameter limit
+    with conn:
+        for start in range(0, len(ids), _SQLITE_MAX_PARAMS):
+            batch = ids[start:start + _SQLITE_MAX_PARAMS]
+            placeholders = ",".join("?" * len(batch))
+            conn.execute(f"UPDATE notifications SET seen=1 WHERE id IN ({placeholders})", batch)
 
 # -------------------------
 # Chemical master list ops
 # -------------------------
-def load_chemicals():
-    return safe_query_df("SELECT serial_no,chemical,amount_total,amount_remaining,issued_total,unit,cas_no FROM chemicals ORDER BY serial_no")
+def _clear_stock_caches():
+    # the chemicals table changed: drop cached list pages and CSV exports
+    load_chemicals.clear()
+    stream_csv.clear()
+    count_rows.clear()
+
+@st.cache_data(ttl=300)
+def load_chemicals(limit=None, offset=0):
+    # cached across reruns (per page); every write to the chemicals table calls _clear_stock_caches()
+    query, params = _paged(_Q_CHEMICALS, (), limit, offset)
+    return safe_query_df(query, params)
 
 def find_chemical_row(chemical_name):
+    with read_conn() as conn:
+        row = conn.execute(_Q_FIND_CHEM, (chemical_name,)).fetchone()
+    return row  # None or sqlite3.Row
+
+def get_chemical_remaining(chemical_name):
+    # narrow lookup for stock checks; None when the chemical is not in the master list.
+    # Stays on the writer connection because it also runs inside update_request_status's transaction;
+    # callers hold _WRITE_LOCK.
     conn = get_conn()
     cur = conn.cursor()
-    cur.execute("SELECT serial_no,chemical,amount_total,amount_remaining,issued_total,unit,cas_no FROM chemicals WHERE chemical = ?", (chemical_name,))
+    cur.execute(_Q_CHEM_REMAINING, (chemical_name,))
     row = cur.fetchone()
-    conn.close()
-    return row  # None or tuple
+    return row[0] if row else None
 
+@_locked
 def adjust_stock(chemical_name, delta):
     """
     delta negative to reduce, positive to add. Returns (ok, message_or_new_remaining)
     """
     conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("SELECT amount_remaining, issued_total FROM chemicals WHERE chemical = ?", (chemical_name,))
-    r = cur.fetchone()
+    # if reducing stock, issued increases
+    with conn:
+        r = conn.execute(_Q_ADJUST_STOCK, (delta, delta, delta, chemical_name, delta)).fetchone()
     if not r:
-        conn.close()
-        return False, "Chemical not found in master list"
-    remaining, issued = r
-    new_remaining = remaining + delta
-    if new_remaining < 0:
-        conn.close()
+        if get_chemical_remaining(chemical_name) is None:
+            return False, "Chemical not found in master list"
         return False, "Insufficient stock"
-    new_issued = issued - delta if delta < 0 else issued  # if reducing stock, issued increases
-    if delta < 0:
-        new_issued = issued + (-delta)
-    cur.execute("UPDATE chemicals SET amount_remaining=?, issued_total=? WHERE chemical=?", (new_remaining, new_issued, chemical_name))
-    conn.commit()
-    conn.close()
-    return True, new_remaining
+    _clear_stock_caches()
+    return True, float(r[0])
 
-def upload_master_from_excel(uploaded_file):
+@_locked
+def delete_master_list():
+    conn = get_conn()
+    with conn:
+        conn.execute("DELETE FROM chemicals")
+    _clear_stock_caches()
+
+def _cell_float(value):
+    # numeric coercion for one spreadsheet cell; blanks and non-numeric text become None
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+def _cell_str(value):
+    return "" if value is None else str(value).strip()
+
+@st.cache_data(max_entries=1)
+def _parse_master_rows(file_bytes):
     # read excel and expect the columns given by user: S.NO., Names, Quantity, Units, Q.Issued, Q.Remaining, CAS.No.
-    df = pd.read_excel(uploaded_file)
-    df.columns = df.columns.str.strip()
+    # cached on the file's content, so uploading the same sheet again skips the XML parse;
+    # only the latest sheet is kept, so earlier uploads don't pile up in server memory
     required = ["S.NO.", "Names", "Quantity", "Units", "Q.Issued", "Q.Remaining", "CAS.No."]
-    if not all(col in df.columns for col in required):
-        raise ValueError("Excel must contain columns: " + ", ".join(required))
+    # stream the sheet row by row in read-only mode instead of building a DataFrame
+    wb = openpyxl.load_workbook(BytesIO(file_bytes), read_only=True, data_only=True)
+    try:
+        it = wb.active.iter_rows(values_only=True)
+        header = [_cell_str(c) for c in next(it, ())]
+        if not all(col in header for col in required):
+            raise ValueError("Excel must contain columns: " + ", ".join(required))
+        # resolve the column positions once; each row is then unpacked positionally
+        pick = itemgetter(*(header.index(name) for name in required))
+        width = len(header)
+        rows = []
+        for r in it:
+            # read-only sheets may return short rows when trailing cells are empty
+            r = tuple(r) + (None,) * (width - len(r))
+            serial, name, qty, unit, issued_total, remaining, cas = pick(r)
+            name = _cell_str(name)
+            if not name:
+                continue  # blank / spacer row
+            serial = _cell_float(serial)
+            qty = _cell_float(qty) or 0.0
+            issued_total = _cell_float(issued_total) or 0.0
+            remaining = _cell_float(remaining)
+            if remaining is None:
+                remaining = qty - issued_total if qty else 0.0
+            if remaining < 0:
+                raise ValueError(f"Q.Remaining for {name} cannot be negative ({remaining})")
+            rows.append((
+                int(serial) if serial is not None else None,
+                name,
+                qty,
+                remaining,
+                issued_total,
+                _cell_str(unit),
+                _cell_str(cas),
+            ))
+    finally:
+        wb.close()
+    return rows
+
+def upload_master_from_excel(uploaded_file):
+    rows = _parse_master_rows(uploaded_file.getvalue())
     conn = get_conn()
-    cur = conn.cursor()
-    # delete existing master list (user requested ability to permanently replace)
-    cur.execute("DELETE FROM chemicals")
-    # insert rows
-    for _, r in df.iterrows():
-        serial = int(r["S.NO."]) if not pd.isna(r["S.NO."]) else None
-        name = str(r["Names"]).strip()
-        qty = float(r["Quantity"]) if not pd.isna(r["Quantity"]) else 0.0
-        unit = str(r["Units"]).strip() if "Units" in r and not pd.isna(r["Units"]) else ""
-        issued_total = float(r["Q.Issued"]) if not pd.isna(r["Q.Issued"]) else 0.0
-        remaining = float(r["Q.Remaining"]) if not pd.isna(r["Q.Remaining"]) else qty - issued_total if qty else 0.0
-        cas = str(r["CAS.No."]).strip() if not pd.isna(r["CAS.No."]) else ""
+    # parse outside the lock; only the replace itself blocks other writers
+    with _WRITE_LOCK, conn:
+        # delete existing master list (user requested ability to permanently replace)
+        conn.execute("DELETE FROM chemicals")
         # upsert
-        cur.execute("""
+        conn.executemany("""
             INSERT INTO chemicals(serial_no,chemical,amount_total,amount_remaining,issued_total,unit,cas_no)
             VALUES (?,?,?,?,?,?,?)
             ON CONFLICT(chemical) DO UPDATE SET
@@ -179,110 +419,160 @@ def upload_master_from_excel(uploaded_file):
                 issued_total=excluded.issued_total,
                 unit=excluded.unit,
                 cas_no=excluded.cas_no
-        """, (serial, name, qty, remaining, issued_total, unit, cas))
-    conn.commit()
-    conn.close()
+        """, rows)
+    _clear_stock_caches()
     return True
 
 # -------------------------
 # Requests and issuance
 # -------------------------
+@_locked
 def create_request(username, chemical, amount, note=""):
     now = datetime.utcnow().isoformat()
     conn = get_conn()
-    cur = conn.cursor()
 
     # Check master list if chemical exists and enforce amount <= remaining
-    cur.execute("SELECT amount_remaining FROM chemicals WHERE chemical = ?", (chemical,))
-    r = cur.fetchone()
-    if r:
-        amt_remain = r[0]
+    amt_remain = get_chemical_remaining(chemical)
+    if amt_remain is not None:
         if float(amount) > float(amt_remain):
-            conn.close()
             return False, f"Requested amount ({amount}) exceeds remaining stock ({amt_remain})."
     # create request
-    cur.execute("""INSERT INTO requests(username,chemical,amount,note,status,created_at,updated_at)
-                   VALUES (?,?,?,?, 'Pending',?,?)""", (username, chemical, float(amount), note, now, now))
-    conn.commit()
-    conn.close()
+    with conn:
+        conn.execute(_Q_INSERT_REQUEST, (username, chemical, float(amount), note, now, now))
+    _clear_request_caches()
     return True, "Request created"
 
-def list_requests(filters=None):
-    # filters is dict where keys match column names
-    base = "SELECT id,username,chemical,amount,note,status,supervisor,lab_incharge,created_at,updated_at FROM requests"
-    params = []
-    if filters:
-        clauses = []
-        for k, v in filters.items():
-            clauses.append(f"{k} = ?")
-            params.append(v)
-        base += " WHERE " + " AND ".join(clauses)
-    base += " ORDER BY created_at DESC"
-    return safe_query_df(base, params)
+def _canonical_query(queries, filters):
+    # look up the prepared query text for this filter shape; anything off the whitelist is rejected
+    keys = tuple(sorted(filters or {}))
+    if keys not in queries:
+        raise ValueError("Unsupported filter: " + ", ".join(keys))
+    return queries[keys], [filters[k] for k in keys]
 
+@st.cache_data(ttl=300)
+def list_requests(filters=None, limit=None, offset=0):
+    # filters is dict where keys match column names
+    query, params = _canonical_query(_REQ_QUERIES, filters)
+    return safe_query_df(*_paged(query, params, limit, offset))
+
+@st.cache_data(ttl=300)
+def list_user_requests(username, limit=None, offset=0):
+    return safe_query_df(*_paged(_Q_USER_REQUESTS, (username,), limit, offset))
+
+def count_requests(filters=None):
+    query, params = _canonical_query(_REQ_COUNTS, filters)
+    return count_rows(query, tuple(params))
+
+def _clear_request_caches():
+    # request lists are cached across reruns; call after any write to the requests table
+    list_requests.clear()
+    list_user_requests.clear()
+    count_rows.clear()
+
+def _issue_request(cur, rid, lab_incharge, now):
+    # Issue one request inside the caller's BEGIN IMMEDIATE transaction.
+    # Returns (ok, message, notifications); a failed issue leaves the database untouched.
+    # deduct stock only if enough remains
+    cur.execute(_Q_DEDUCT_FOR_REQUEST, (rid,))
+    if not cur.fetchone():
+        # nothing deducted; the extra lookups only run on this failure path
+        cur.execute(_Q_REQUEST_BY_ID, (rid,))
+        row = cur.fetchone()
+        if not row:
+            return False, "Request not found", []
+        if row["status"] != "Approved":
+            return False, "Request is not in Approved state.", []
+        remaining = get_chemical_remaining(row["chemical"])
+        if remaining is None:
+            return False, "Chemical not found in master list — cannot issue from stock", []
+        return False, f"Insufficient stock. Remaining: {remaining}", []
+    cur.execute(_Q_SET_ISSUED_STATUS, ("Issued", lab_incharge, now, rid))
+    req_user, chem, amt = cur.fetchone()
+    amt = float(amt)  # RETURNING hands back the stored value, which SQLite may keep as an integer
+    # insert into issued
+    cur.execute("INSERT INTO issued(username,chemical,amount,issued_by,issued_at) VALUES (?,?,?,?,?)",
+                (req_user, chem, amt, lab_incharge, now))
+    return True, "Issued", [(req_user, f"Your request #{rid} for {amt} {chem} has been ISSUED by {lab_incharge}.")]
+
+def _clear_issue_caches():
+    _clear_request_caches()
+    _clear_stock_caches()
+    list_issued.clear()
+
+@_locked
 def update_request_status(rid, status, supervisor=None, lab_incharge=None):
     now = datetime.utcnow().isoformat()
     conn = get_conn()
     cur = conn.cursor()
-    cur.execute("SELECT status, username, chemical, amount FROM requests WHERE id = ?", (rid,))
-    row = cur.fetchone()
-    if not row:
-        conn.close()
-        return False, "Request not found"
-    old_status, req_user, chem, amt = row
-    if status == "Approved":
-        cur.execute("UPDATE requests SET status=?, supervisor=?, updated_at=? WHERE id=?", (status, supervisor, now, rid))
-        conn.commit()
-        conn.close()
-        # notify user and lab_incharge
-        push_notification(req_user, f"Your request #{rid} for {amt} {chem} was APPROVED by {supervisor}.")
-        push_notification("lab_incharge", f"Request #{rid} for {amt} {chem} by {req_user} approved by {supervisor}.")
-        return True, "Approved"
-    elif status == "Rejected":
-        cur.execute("UPDATE requests SET status=?, supervisor=?, updated_at=? WHERE id=?", (status, supervisor, now, rid))
-        conn.commit()
-        conn.close()
-        push_notification(req_user, f"Your request #{rid} for {amt} {chem} was REJECTED by {supervisor}.")
-        return True, "Rejected"
-    elif status == "Issued":
-        # ensure enough stock
-        cur.execute("SELECT amount_remaining FROM chemicals WHERE chemical = ?", (chem,))
-        r2 = cur.fetchone()
-        if not r2:
-            conn.close()
-            return False, "Chemical not found in master list — cannot issue from stock"
-        remaining = r2[0]
-        if float(amt) > float(remaining):
-            conn.close()
-            return False, f"Insufficient stock. Remaining: {remaining}"
-        # deduct and record
-        new_remaining = remaining - float(amt)
-        # update chemicals
-        cur.execute("UPDATE chemicals SET amount_remaining = amount_remaining - ?, issued_total = issued_total + ? WHERE chemical = ?", (float(amt), float(amt), chem))
-        # update requests
-        cur.execute("UPDATE requests SET status = ?, lab_incharge = ?, updated_at = ? WHERE id = ?", (status, lab_incharge, now, rid))
-        # insert into issued
-        cur.execute("INSERT INTO issued(username,chemical,amount,issued_by,issued_at) VALUES (?,?,?,?,?)",
-                    (req_user, chem, float(amt), lab_incharge, now))
-        conn.commit()
-        conn.close()
-        push_notification(req_user, f"Your request #{rid} for {amt} {chem} has been ISSUED by {lab_incharge}.")
-        return True, "Issued"
+    # BEGIN IMMEDIATE takes the write lock up front, so every statement below forms one
+    # transaction; `with conn` commits it (or rolls back on error)
+    with conn:
+        cur.execute("BEGIN IMMEDIATE")
+        if status == "Issued":
+            ok, msg, notifs = _issue_request(cur, rid, lab_incharge, now)
+            if not ok:
+                return False, msg
+        elif status in ("Approved", "Rejected"):
+            cur.execute(_Q_SET_SUPERVISOR_STATUS, (status, supervisor, now, rid))
+            row = cur.fetchone()
+            if not row:
+                # nothing updated; look up why only on this failure path
+                cur.execute(_Q_REQUEST_BY_ID, (rid,))
+                if not cur.fetchone():
+                    return False, "Request not found"
+                return False, "Request is not in Pending state."
+            req_user, chem, amt = row
+            amt = float(amt)
+            if status == "Approved":
+                # notify user and lab_incharge
+                notifs = [
+                    (req_user, f"Your request #{rid} for {amt} {chem} was APPROVED by {supervisor}."),
+                    ("lab_incharge", f"Request #{rid} for {amt} {chem} by {req_user} approved by {supervisor}."),
+                ]
+            else:
+                notifs = [(req_user, f"Your request #{rid} for {amt} {chem} was REJECTED by {supervisor}.")]
+        else:
+            return False, "Unsupported status"
+        # notifications commit together with the status change
+        push_notifications(notifs, cur=cur, now=now)
+
+    if status == "Issued":
+        _clear_issue_caches()
     else:
-        conn.close()
-        return False, "Unsupported status"
-
-def list_issued(filters=None):
-    base = "SELECT id,username,chemical,amount,issued_by,issued_at FROM issued"
-    params = []
-    if filters:
-        clauses = []
-        for k, v in filters.items():
-            clauses.append(f"{k} = ?")
-            params.append(v)
-        base += " WHERE " + " AND ".join(clauses)
-    base += " ORDER BY issued_at DESC"
-    return safe_query_df(base, params)
+        _clear_request_caches()
+    return True, status
+
+@_locked
+def batch_issue(rids, lab_incharge):
+    """
+    Issue several approved requests in one transaction (one commit for the whole batch).
+    Returns [(rid, ok, message), ...]; a request that cannot be issued is skipped and
+    does not affect the others.
+    """
+    now = datetime.utcnow().isoformat()
+    conn = get_conn()
+    cur = conn.cursor()
+    results = []
+    notifs = []
+    with conn:
+        cur.execute("BEGIN IMMEDIATE")
+        for rid in rids:
+            ok, msg, n = _issue_request(cur, rid, lab_incharge, now)
+            results.append((rid, ok, msg))
+            notifs.extend(n)
+        push_notifications(notifs, cur=cur, now=now)
+    if notifs:
+        _clear_issue_caches()
+    return results
+
+@st.cache_data(ttl=300)
+def list_issued(filters=None, limit=None, offset=0):
+    query, params = _canonical_query(_ISSUED_QUERIES, filters)
+    return safe_query_df(*_paged(query, params, limit, offset))
+
+def count_issued(filters=None):
+    query, params = _canonical_query(_ISSUED_COUNTS, filters)
+    return count_rows(query, tuple(params))
 
 # -------------------------
 # UI sections
@@ -297,21 +587,12 @@ def login_area():
             st.sidebar.error("Enter a username")
             return None
         # register user (non-sensitive)
-        conn = get_conn()
-        cur = conn.cursor()
-        try:
-            cur.execute("INSERT OR IGNORE INTO users(username, full_name) VALUES (?, ?)", (username.strip(), username.strip()))
-            conn.commit()
-        finally:
-            conn.close()
+        register_user(username.strip())
         st.session_state['user'] = {"username": username.strip(), "role": role}
     return None
 
-def show_notifications():
-    if 'user' not in st.session_state:
-        return
-    u = st.session_state['user']['username']
-    rows = get_unseen_notifications(u)
+def show_notifications(username):
+    rows = get_unseen_notifications(username)
     if rows:
         st.info(f"You have {len(rows)} new notification(s).")
         for nid, msg, c_at in rows:
@@ -321,9 +602,19 @@ def show_notifications():
             mark_notifications_seen(ids)
             st.experimental_rerun()
 
+def page_controls(key, total):
+    # returns (limit, offset) for the page picked in a small "Page" input, bounded by the row count
+    pages = max(1, -(-total // PAGE_SIZE))
+    if st.session_state.get(key, 1) > pages:
+        st.session_state[key] = pages  # the table shrank since the page was picked
+    page = st.number_input("Page", min_value=1, max_value=pages, step=1, key=key)
+    st.caption(f"{total} rows, page {page} of {pages}")
+    return PAGE_SIZE, (page - 1) * PAGE_SIZE
+
 def user_dashboard(user):
+    username = user['username']
     st.title("Chemical Record Keeper — User")
-    show_notifications()
+    show_notifications(username)
     st.header("Request a Chemical")
     with st.form("request_form", clear_on_submit=True):
         chem = st.text_input("Chemical name (type freely)")
@@ -331,60 +622,66 @@ def user_dashboard(user):
         note = st.text_area("Note (optional)")
         submitted = st.form_submit_button("Submit Request")
         if submitted:
-            ok, msg = create_request(user['username'], chem.strip(), amount, note.strip())
+            ok, msg = create_request(username, chem.strip(), amount, note.strip())
             if ok:
                 st.success("Request submitted.")
             else:
                 st.error(msg)
 
     st.subheader("My Requests")
-    df = safe_query_df("SELECT id,chemical,amount,status,created_at,updated_at FROM requests WHERE username = ? ORDER BY created_at DESC", (user['username'],))
+    limit, offset = page_controls("my_requests_page", count_requests({"username": username}))
+    df = list_user_requests(username, limit=limit, offset=offset)
     st.dataframe(df)
 
     st.subheader("My Issued Records")
-    df2 = list_issued(filters={"username": user['username']})
+    limit, offset = page_controls("my_issued_page", count_issued({"username": username}))
+    df2 = list_issued(filters={"username": username}, limit=limit, offset=offset)
     st.dataframe(df2)
 
 def supervisor_dashboard(user):
+    username = user['username']
     st.title("Chemical Record Keeper — Supervisor")
-    show_notifications()
+    show_notifications(username)
     st.header("Pending Requests")
-    df = list_requests(filters={"status": "Pending"})
+    limit, offset = page_controls("pending_page", count_requests({"status": "Pending"}))
+    df = list_requests(filters={"status": "Pending"}, limit=limit, offset=offset)
     st.dataframe(df)
 
     st.subheader("Approve / Reject Request")
     cols = st.columns([1,1,2])
     rid = cols[0].number_input("Request ID", min_value=1, step=1)
     if cols[1].button("Approve"):
-        ok, msg = update_request_status(rid, "Approved", supervisor=user['username'])
+        ok, msg = update_request_status(rid, "Approved", supervisor=username)
         if ok:
             st.success("Approved.")
         else:
             st.error(msg)
     if cols[1].button("Reject"):
-        ok, msg = update_request_status(rid, "Rejected", supervisor=user['username'])
+        ok, msg = update_request_status(rid, "Rejected", supervisor=username)
         if ok:
             st.info("Rejected.")
         else:
             st.error(msg)
 
     st.subheader("Master Chemical List (PRIVATE)")
-    chems = load_chemicals()
+    limit, offset = page_controls("chemicals_page", count_rows(_Q_COUNT_CHEMICALS))
+    chems = load_chemicals(limit=limit, offset=offset)
     st.dataframe(chems)
 
     st.subheader("Downloads (Supervisor)")
-    csv_chems = chems.to_csv(index=False)
-    st.download_button("Download Chemical List (CSV)", csv_chems, "chemical_list.csv")
+    # downloads always export the full tables, not the page on screen
+    st.download_button("Download Chemical List (CSV)", stream_csv(_Q_CHEMICALS), "chemical_list.csv", mime="text/csv")
 
-    issued = list_issued()
-    st.download_button("Download Issued Log (CSV)", issued.to_csv(index=False), "issued_log.csv")
+    st.download_button("Download Issued Log (CSV)", stream_csv(_Q_ISSUED_LOG), "issued_log.csv", mime="text/csv")
 
 def lab_dashboard(user):
+    username = user['username']
     st.title("Chemical Record Keeper — Lab Incharge")
-    show_notifications()
+    show_notifications(username)
 
     st.header("Requests Awaiting Issuance (Approved)")
-    df = list_requests(filters={"status":"Approved"})
+    limit, offset = page_controls("approved_page", count_requests({"status": "Approved"}))
+    df = list_requests(filters={"status":"Approved"}, limit=limit, offset=offset)
     st.dataframe(df)
 
     st.subheader("Issue a Request")
@@ -392,61 +689,58 @@ def lab_dashboard(user):
     rid = cols[0].number_input("Request ID", min_value=1, step=1)
     btn_issue = cols[1].button("Issue Request")
     if btn_issue:
-        # find request details
-        conn = get_conn()
-        cur = conn.cursor()
-        cur.execute("SELECT username, chemical, amount, status FROM requests WHERE id = ?", (rid,))
-        r = cur.fetchone()
-        conn.close()
-        if not r:
-            st.error("Request not found.")
+        # the Approved-state and stock checks happen atomically inside update_request_status
+        ok, msg = update_request_status(rid, "Issued", lab_incharge=username)
+        if ok:
+            st.success("Issued successfully.")
         else:
-            req_user, chem, amt, status = r
-            if status != "Approved":
-                st.error("Request is not in Approved state.")
+            st.error(msg)
+
+    # issue several approved requests from this page at once, committed together
+    selected = st.multiselect("Approved requests to issue together", df["id"].tolist())
+    if st.button("Issue Selected") and selected:
+        for rid, ok, msg in batch_issue(selected, username):
+            if ok:
+                st.success(f"Request #{rid} issued.")
             else:
-                # try to issue
-                ok, msg = update_request_status(rid, "Issued", lab_incharge=user['username'])
-                if ok:
-                    st.success("Issued successfully.")
-                else:
-                    st.error(msg)
+                st.error(f"Request #{rid}: {msg}")
 
     st.subheader("Master Chemical List (PRIVATE)")
-    chems = load_chemicals()
+    limit, offset = page_controls("chemicals_page", count_rows(_Q_COUNT_CHEMICALS))
+    chems = load_chemicals(limit=limit, offset=offset)
     st.dataframe(chems)
 
     st.subheader("Upload / Replace Master Chemical List (Excel)")
     uploaded = st.file_uploader("Upload .xlsx file (must include S.NO., Names, Quantity, Units, Q.Issued, Q.Remaining, CAS.No.)", type=["xlsx"])
-    if uploaded is not None:
+    # the uploader keeps returning the same file on every rerun; only apply each upload once,
+    # otherwise any later click would re-import the sheet and wipe stock changes made since
+    if uploaded is not None and st.session_state.get("applied_upload_id") != uploaded.file_id:
         try:
             upload_master_from_excel(uploaded)
+            st.session_state["applied_upload_id"] = uploaded.file_id
             st.success("Master list uploaded.")
         except Exception as e:
             st.error("Upload failed: " + str(e))
 
     if st.button("Delete Master Chemical List (PERMANENT)"):
-        conn = get_conn()
-        cur = conn.cursor()
-        cur.execute("DELETE FROM chemicals")
-        conn.commit()
-        conn.close()
+        delete_master_list()
         st.warning("Master chemical list deleted permanently.")
 
     st.subheader("Issued Records (All Users)")
-    issued = list_issued()
+    limit, offset = page_controls("issued_page", count_issued())
+    issued = list_issued(limit=limit, offset=offset)
     st.dataframe(issued)
 
     st.subheader("Downloads (Lab)")
-    st.download_button("Download Chemical List (CSV)", chems.to_csv(index=False), "chemical_list.csv")
-    st.download_button("Download Issued Log (CSV)", issued.to_csv(index=False), "issued_log.csv")
+    st.download_button("Download Chemical List (CSV)", stream_csv(_Q_CHEMICALS), "chemical_list.csv", mime="text/csv")
+    st.download_button("Download Issued Log (CSV)", stream_csv(_Q_ISSUED_LOG), "issued_log.csv", mime="text/csv")
 
 # -------------------------
 # Main
 # -------------------------
 def main():
     st.set_page_config(page_title="Chemical Record Keeper", layout="wide")
-    init_db()
+    _init_db_once()
 
     if 'user' not in st.session_state:
         st.session_state['user'] = None